@@ -29,14 +29,25 @@ Todo:
 """
 
 import os
+import re
 import json
+import time
+import base64
+import types
 import fnmatch
+import hashlib
+import binascii
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 config = {
     'date_format': os.environ.get('DATE_FORMAT', '%B %d, %Y'),
+    'max_workers': int(os.environ.get('MAX_WORKERS', 10)),
     'docker_hub': {
         'api_base_url': os.environ.get('DOCKERHUB_API_BASE_URL',
                                        'https://hub.docker.com/v2'),
@@ -62,64 +73,108 @@ org, repo = os.environ.get('DOCKERHUB_REPOSITORY').split('/')
 config['docker_hub']['organization'] = org
 config['docker_hub']['repository'] = repo
 
+# Attribute views of the config sections: nested dict subscripts in the
+# request helpers become attribute loads, and a typo fails at import time
+# instead of deep inside a loop.
+DH = types.SimpleNamespace(**config['docker_hub'])
+MD = types.SimpleNamespace(**config['markdown'])
+
+# Loop invariants hoisted out of the per-line Markdown parsing helpers
+MD_BEGIN = MD.begin_string
+MD_END = MD.end_string
+MD_TAG_COL = int(MD.tag_column)
+MD_DATE_COL = int(MD.date_column)
+
+# Docker Hub tokens are valid for hours, so they are cached on disk and
+# reused by subsequent runs (e.g. scheduled CI jobs) until they expire.
+TOKEN_CACHE_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'docker-hub-tag-delete', 'token.json')
+
+# ETags and bodies of tag-list responses, keyed by request, so frequent
+# runs can revalidate with If-None-Match instead of re-downloading pages
+ETAG_CACHE_DIR = os.path.join(os.path.dirname(TOKEN_CACHE_FILE), 'etags')
+
 now = datetime.now()
+
+# Size the connection pool for the thread-pool fan-out and retry with
+# exponential backoff on rate limits and transient server errors.
 session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=config['max_workers'] * 2,
+    pool_maxsize=config['max_workers'] * 2,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['GET', 'DELETE', 'POST']))
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
 
 
 def line_is_ignored(line):
     """Check if a line from Markdown should be ignored"""
-    ignore_lines = [
-        config['markdown']['begin_string'],
-        config['markdown']['end_string']
-    ]
-    for ignore in ignore_lines:
-        if line.startswith(ignore):
-            return True
-    return False
+    return line.startswith((MD_BEGIN, MD_END))
 
 
 def get_readme_table():
     """Return rows from a Markdown table that list tag patterns and deletion
         dates
     """
-    md_file = open(config['markdown']['file'], 'r').readlines()
     parsing = False
     items = []
     linenum = 0
-    for line in md_file:
-        if line.startswith(config['markdown']['begin_string']):
-            parsing = True
-        if parsing:
-            if line.startswith('|') and not line_is_ignored(line):
-                # ignore empty lines
-                if line.strip():
-                    linenum += 1
-                    # Skip the header and separator (first two lines)
-                    if linenum > 2:
-                        items.append(parse_md_line(line))
-        if line.startswith(config['markdown']['end_string']):
-            parsing = False
+    with open(MD.file, 'r') as md_file:
+        for line in md_file:
+            if line.startswith(MD_BEGIN):
+                parsing = True
+            if parsing:
+                if line.startswith('|') and not line_is_ignored(line):
+                    # ignore empty lines
+                    if line.strip():
+                        linenum += 1
+                        # Skip the header and separator (first two lines)
+                        if linenum > 2:
+                            items.append(parse_md_line(line))
+            if line.startswith(MD_END):
+                # The table is done; no need to read the rest of the file
+                break
 
     return items
 
 
+@functools.lru_cache(maxsize=None)
 def parse_date(date):
-    """Parse a date string and return a datetime object"""
-    return datetime.strptime(date, config['date_format'])
+    """Parse a date string and return a datetime object
+
+    Rows frequently repeat the same deletion date, so results are memoized
+    to pay the parsing cost once per distinct string. ISO dates
+    ('2022-10-06') are always accepted via CPython's fromisoformat fast
+    path; anything else is parsed with the configured DATE_FORMAT.
+    """
+    # fromisoformat only understands the 'Z' suffix on Python 3.11+
+    iso = date[:-1] + '+00:00' if date.endswith('Z') else date
+    try:
+        parsed = datetime.fromisoformat(iso)
+    except ValueError:
+        return datetime.strptime(date, config['date_format'])
+    # Normalize timezone-aware values ('...T00:00:00Z'), which cannot be
+    # compared against the naive 'now'
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
 
 
 def parse_md_line(md_line):
     """Extract tag patterns and expiration dates from a Markdown table row"""
     md = md_line.strip().split('|')
 
-    if int(config['markdown']['tag_column']) > (len(md) - 1):
+    if MD_TAG_COL > (len(md) - 1):
         raise IndexError('tag column is out of range.')
-    if int(config['markdown']['date_column']) > (len(md) - 1):
+    if MD_DATE_COL > (len(md) - 1):
         raise IndexError('date column is out of range.')
 
     # Determine which table column the tags and date are in
-    tags = md[int(config['markdown']['tag_column'])]
-    date = md[int(config['markdown']['date_column'])]
+    tags = md[MD_TAG_COL]
+    date = md[MD_DATE_COL]
 
     tags = tags.strip().replace('`', '')
     date = date.strip()
@@ -130,130 +185,275 @@ def parse_md_line(md_line):
 def json_tags():
     """Load a JSON file with tag deletions specified."""
     with open(config['json']['file'], 'r') as f:
-        data = list(json.load(f))
-        return data
+        return json.load(f)
 
 
 def get_tag_list():
     """Returns a list of tag patterns from the source"""
     tags = []
     if config['json']['file']:
-        tags.append(json_tags())
-    if config['markdown']['file']:
-        tags.append(get_readme_table())
-    tags = [i for row in tags for i in row]
+        tags.extend(json_tags())
+    if MD.file:
+        tags.extend(get_readme_table())
     return tags
 
 
+@functools.lru_cache(maxsize=None)
+def _translate(pattern):
+    """Return the regex source for an fnmatch pattern"""
+    return fnmatch.translate(pattern)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled(*patterns):
+    """Return one compiled regex matching any of the fnmatch patterns"""
+    return re.compile('|'.join(f'(?:{_translate(p)})' for p in patterns))
+
+
 def tags_to_delete():
     """Return a list of tags to delete based on the deletion date"""
-    tags_list = []
-    for item in get_tag_list():
-        if now >= parse_date(item['date']):
-            for pattern in item['tags']:
-                pattern = pattern.strip()
-                t = tags_matching_pattern(pattern)
-                tags_list.append(t)
-    # Flatten list
-    if len(tags_list) > 0:
-        tags_list = [i for row in tags_list for i in row]
-    return tags_list
+    # Keep only the entries that are already due, oldest first, before any
+    # network activity; if nothing is expired we never talk to Docker Hub.
+    expired = [i for i in get_tag_list() if now >= parse_date(i['date'])]
+    expired.sort(key=lambda i: parse_date(i['date']))
+
+    patterns = []
+    for item in expired:
+        for pattern in item['tags']:
+            patterns.append(pattern.strip())
+
+    if not patterns:
+        return []
+
+    # Literal patterns (no wildcard characters) are resolved with a plain
+    # set intersection; only real globs go through the regex.
+    literals = set()
+    globs = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            globs.append(pattern)
+        else:
+            literals.add(pattern)
+
+    # Fetch the tag list once and match every pattern against it in memory,
+    # rather than re-walking the paginated API per pattern. The alternation
+    # regex checks all glob patterns in a single pass over the names, so a
+    # tag matched by overlapping patterns is only reported once.
+    all_tags = list_all_tags()
+    matches = literals & set(all_tags)
+    if globs:
+        regex = _compiled(*globs)
+        matches.update(t for t in all_tags if regex.match(t))
+    # Sorted for stable, reproducible output across runs
+    return sorted(matches)
 
 
 def delete_expired_tags():
-    """Delete tags from the Docker Hub registry using the API"""
-    deleted = []
+    """Delete tags from the Docker Hub registry using the API
 
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {docker_hub_token()}"
-    }
-
-    for tag in tags_to_delete():
-        url = '/namespaces/' + config['docker_hub']['organization'] \
-                + '/repositories/' + config['docker_hub']['repository'] \
-                + '/tags/' + tag
+    Deletions are independent of each other, so they are issued concurrently
+    with a thread pool instead of waiting out one round-trip per tag.
+    """
+    base_url = DH.api_base_url + '/namespaces/' + DH.organization \
+        + '/repositories/' + DH.repository + '/tags/'
 
-        resp = session.delete(
-            config['docker_hub']['api_base_url'] + url,
-            headers=headers
-        )
+    def delete_tag(tag):
+        resp = api_request('DELETE', base_url + tag)
         resp.raise_for_status()
-        deleted.append(tag)
-    return deleted
-
+        return tag
 
+    # Collect failures instead of letting the first one abort the rest of
+    # the in-flight deletions; re-raise once every tag has been attempted.
+    deleted = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=config['max_workers']) as executor:
+        futures = {executor.submit(delete_tag, tag): tag
+                   for tag in tags_to_delete()}
+        for future in as_completed(futures):
+            try:
+                deleted.append(future.result())
+            except requests.exceptions.RequestException as e:
+                errors.append((futures[future], e))
+
+    if errors:
+        for tag, error in errors:
+            print(f"! Failed to delete {tag}: {error}")
+        raise errors[0][1]
+    # Futures complete in arbitrary order; sort so the summary is stable
+    return sorted(deleted)
+
+
+def _token_expiry(token):
+    """Return the 'exp' claim of a JWT as a unix timestamp, or None"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return int(claims['exp'])
+    except (IndexError, KeyError, ValueError, binascii.Error):
+        return None
+
+
+def _read_cached_token():
+    """Return a still-valid token from the cache file, or None"""
+    try:
+        with open(TOKEN_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+        # A malformed cache entry falls back to a fresh login
+        if not isinstance(cached, dict) or 'token' not in cached \
+                or not isinstance(cached.get('exp'), (int, float)):
+            return None
+        # A minute of headroom so we never send a token about to expire
+        if cached['exp'] > time.time() + 60:
+            return cached['token']
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _write_cached_token(token, exp):
+    """Store the token and its expiry in a file only we can read"""
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), exist_ok=True)
+        fd = os.open(TOKEN_CACHE_FILE,
+                     os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': token, 'exp': exp}, f)
+    except OSError:
+        # Caching is best-effort; a read-only filesystem is not fatal
+        pass
+
+
+def invalidate_token():
+    """Drop the cached token so the next call logs in again"""
+    docker_hub_token.cache_clear()
+    try:
+        os.remove(TOKEN_CACHE_FILE)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=1)
 def docker_hub_token():
-    """Return an auth token for the Docker Hub API"""
-    headers = {"Content-type": "application/json"}
-    body = json.dumps({
-        'username': config['docker_hub']['username'],
-        'password': config['docker_hub']['password']
-    })
-    auth = session.post(config['docker_hub']['api_base_url'] + '/users/login',
-                        headers=headers, data=body)
+    """Return an auth token for the Docker Hub API
+
+    The token is cached for the lifetime of the process and persisted on
+    disk with its expiry, so warm runs skip the '/users/login' round-trip
+    entirely.
+    """
+    token = _read_cached_token()
+    if token:
+        return token
+
+    auth = session.post(DH.api_base_url + '/users/login',
+                        json={'username': DH.username,
+                              'password': DH.password})
     auth.raise_for_status()
     content = auth.json()
-    return content['token']
+    token = content['token']
 
+    exp = _token_expiry(token)
+    if exp:
+        _write_cached_token(token, exp)
+    return token
 
-def tags_matching_pattern(pattern):
-    """Compares tags on Docker Hub to our tag patterns and returns a list of
-        matching tags that are on Docker Hub
-    """
-    url = '/namespaces/' \
-        + config['docker_hub']['organization'] \
-        + '/repositories/' \
-        + config['docker_hub']['repository'] + '/tags'
 
+def api_request(method, url, **kwargs):
+    """Issue an authenticated API request, refreshing a stale token once
+        on a 401
+    """
     headers = {
         "Content-type": "application/json",
         "Authorization": f"Bearer {docker_hub_token()}"
     }
+    headers.update(kwargs.pop('headers', {}))
+    resp = session.request(method, url, headers=headers, **kwargs)
+    if resp.status_code == 401:
+        invalidate_token()
+        headers["Authorization"] = f"Bearer {docker_hub_token()}"
+        resp = session.request(method, url, headers=headers, **kwargs)
+    return resp
+
+
+def cached_get(url, params):
+    """GET a JSON document, revalidating an on-disk copy with its ETag
+
+    A 304 Not Modified response is served from the cached body, turning a
+    full page download into a header-only round-trip.
+    """
+    key = hashlib.sha256(
+        repr((url, sorted(params.items()))).encode()).hexdigest()
+    path = os.path.join(ETAG_CACHE_DIR, key + '.json')
+
+    cached = None
+    try:
+        with open(path, 'r') as f:
+            cached = json.load(f)
+        # A malformed cache entry falls back to an unconditional GET
+        if not isinstance(cached, dict) \
+                or 'etag' not in cached or 'body' not in cached:
+            cached = None
+    except (OSError, ValueError):
+        pass
+
+    headers = {'If-None-Match': cached['etag']} if cached else {}
+    resp = api_request('GET', url, params=params, headers=headers)
+    if resp.status_code == 304 and cached:
+        return cached['body']
+    resp.raise_for_status()
+
+    body = resp.json()
+    etag = resp.headers.get('ETag')
+    if etag:
+        try:
+            os.makedirs(ETAG_CACHE_DIR, exist_ok=True)
+            fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'etag': etag, 'body': body}, f)
+        except OSError:
+            # Caching is best-effort; a read-only filesystem is not fatal
+            pass
+    return body
+
+
+def list_all_tags():
+    """Return the names of all tags on the Docker Hub repository"""
+    url = DH.api_base_url + '/namespaces/' + DH.organization \
+        + '/repositories/' + DH.repository + '/tags'
 
     params = {
         'page_size': 100,
         'ordering': 'name'
     }
 
-    resp = session.get(
-        config['docker_hub']['api_base_url'] + url,
-        headers=headers,
-        params=params
-    )
-    _next = None
-    matching_tags = []
-    # Loop through pagination
-    while True:
-        if _next:
-            resp = session.get(_next, headers=headers)
-            try:
-                resp.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 404:
-                    # Handle the 404 error here
-                    break
-                raise
+    def get_page(page):
+        try:
+            return cached_get(url, dict(params, page=page))['results']
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                # The tag list shrank while we were paginating
+                return []
+            raise
 
-        resp = resp.json()
-        for i in resp['results']:
-            if fnmatch.fnmatch(i['name'], pattern):
-                matching_tags.append(i['name'])
+    first = cached_get(url, params)
+    results = list(first['results'])
 
-        if resp['next']:
-            _next = resp['next']
-            continue
+    # The first page tells us the total count, so the remaining pages can be
+    # fetched concurrently instead of following 'next' links one at a time.
+    pages = -(-first['count'] // params['page_size'])
+    if pages > 1:
+        with ThreadPoolExecutor(max_workers=config['max_workers']) as executor:
+            for page in executor.map(get_page, range(2, pages + 1)):
+                results.extend(page)
 
-        return matching_tags
+    return [i['name'] for i in results]
 
 
 if __name__ == "__main__":
-    _tags = tags_to_delete()
+    _tags = delete_expired_tags()
     if len(_tags) > 0:
-        delete_expired_tags()
         for _tag in _tags:
-            img_tag = config['docker_hub']['organization'] + '/' \
-                    + config['docker_hub']['repository'] + ':' + _tag
+            img_tag = DH.organization + '/' + DH.repository + ':' + _tag
             print(f"> Deleted {img_tag}")
     else:
         print("There are no tags to delete.")
@@ -28,6 +28,13 @@ def test_parse_date():
     date = "October 6, 2022"
     assert target.parse_date(date) == datetime(2022, 10, 6, 0, 0)
 
+    # ISO dates are accepted regardless of DATE_FORMAT
+    assert target.parse_date('2022-10-06') == datetime(2022, 10, 6, 0, 0)
+
+    # Aware ISO values are normalized so they compare against the naive now
+    aware = target.parse_date('2022-10-06T00:00:00Z')
+    assert aware.tzinfo is None
+
 def test_parse_md_line():
     mdline = '| `1.*`, `2.0` | October 6, 2022'
     result = {'tags': ['1.*',' 2.0'], 'date': 'October 6, 2022'}
@@ -66,7 +73,7 @@ def test_docker_hub_token():
 	"""Docker Hub required"""
 	pass
 
-def test_tags_matching_pattern():
+def test_list_all_tags():
 	"""Docker Hub required"""
 	pass
 